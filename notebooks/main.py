@@ -1,82 +1,124 @@
 import geopandas as gpd
 import pandas as pd
+import numpy as np
+import pyogrio
+import shapely
+from shapely.errors import GEOSException
 import logging
 import os
 import gc
-from multiprocessing import Process
+from pathlib import Path
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from publicspace.publicspace import PublicSpace
 from publicspace.settings import BGT_LAYERS, TOP10NL_LAYERS
 import tempfile
 import subprocess
 import shutil
 
 # Subproces-functie
-def run_analysis_for_polygon(idx, row, crs, base_output_path, aoi_name):
+def run_analysis_for_polygon(idx, wkb, attrs, crs, base_output_path, aoi_name, threads=1):
     import geopandas as gpd
     from publicspace.publicspace import PublicSpace
-    from shapely.validation import make_valid
+    import shapely
     import os
 
     try:
-        geom = gpd.GeoDataFrame([row], crs=crs)
-        geom["geometry"] = geom["geometry"].apply(make_valid)
-        geom = geom[geom.geometry.notnull() & ~geom.geometry.is_empty]
+        geom = gpd.GeoDataFrame([attrs], geometry=[shapely.from_wkb(wkb)], crs=crs)
+        geoms = shapely.make_valid(geom.geometry.values.to_numpy())
+        keep = ~shapely.is_missing(geoms) & ~shapely.is_empty(geoms)
+        geom = geom[keep].set_geometry(geoms[keep], crs=crs)
 
         output_id = f"{aoi_name}_area{idx}"
-        bgt_path = os.path.join(base_output_path, output_id, "BGT")
-        top10nl_path = os.path.join(base_output_path, output_id, "TOP10NL")
         export_path = os.path.join(base_output_path, f"{output_id}.gpkg")
         export_aggregate_path = os.path.join(base_output_path, f"{output_id}_geaggregeerd.gpkg")
 
-        if os.path.exists(export_path) and os.path.exists(export_aggregate_path):
+        if Path(export_path).is_file() and Path(export_aggregate_path).is_file():
             print(f"[{output_id}] overslaan: resultaten bestaan al.")
             return
 
         os.makedirs(os.path.dirname(export_path), exist_ok=True)
         os.makedirs(os.path.dirname(export_aggregate_path), exist_ok=True)
 
-        ps = PublicSpace(
-            aoi=geom,
-            bgt_path=bgt_path,
-            bgt_layers=BGT_LAYERS,
-            bgt_download=True,
-            top10nl_path=top10nl_path,
-            top10nl_layers=TOP10NL_LAYERS,
-            top10nl_download=True
-        )
-
-        ps.export(export_path)
-        ps.export_aggregate(export_aggregate_path)
+        # Tussenresultaten (downloads) in een eigen tijdelijke map per worker op de lokale schijf; deze wordt na
+        # het exporteren automatisch verwijderd. Alleen de twee uitvoerbestanden blijven bewaard.
+        with tempfile.TemporaryDirectory(prefix=f"ps_{output_id}_", ignore_cleanup_errors=True) as scratch:
+            ps = PublicSpace(
+                aoi=geom,
+                bgt_path=os.path.join(scratch, "BGT"),
+                bgt_layers=BGT_LAYERS,
+                bgt_download=True,
+                top10nl_path=os.path.join(scratch, "TOP10NL"),
+                top10nl_layers=TOP10NL_LAYERS,
+                top10nl_download=True,
+                max_workers=threads
+            )
+
+            ps.export(export_path)
+            aggregate = ps.export_aggregate(export_aggregate_path)
+
+            # Dezelfde resultaten als Arrow IPC, zodat het samenvoegen de GeoPackages niet opnieuw hoeft te parsen
+            ps.gdf.to_feather(os.path.splitext(export_path)[0] + ".arrow")
+            aggregate.to_feather(os.path.splitext(export_aggregate_path)[0] + ".arrow")
+            del ps, aggregate
 
         print(f"[{output_id}] voltooid.")
-        del ps, geom
+        del geom
         gc.collect()
     except Exception as e:
         print(f"[{aoi_name}_area{idx}] FOUT: {e}")
 
+# Samenvoegen van de geometrieën binnen een groep
+def union_geometries(geometries):
+    geoms = np.asarray(geometries)
+
+    # Aangrenzende polygonen zonder overlap (coverage) kunnen veel sneller samengevoegd worden. Bij overlap geeft
+    # GEOS een fout, een ongeldig resultaat of een afwijkende oppervlakte; val dan terug op een volledige union.
+    try:
+        union = shapely.coverage_union_all(geoms)
+        if shapely.is_valid(union) and np.isclose(shapely.area(union), shapely.area(geoms).sum()):
+            return union
+    except GEOSException:
+        pass
+    return shapely.union_all(geoms)
+
+# Leest een deelresultaat: Arrow IPC indien beschikbaar, anders GeoPackage
+def read_result(file):
+    if file.endswith(".arrow"):
+        return gpd.read_feather(file)
+    return pyogrio.read_dataframe(file, use_arrow=True)
+
 # Merge-functie
-def merge_geopackages(input_files, output_file, dissolve_columns=None):
-    merged = None
+def merge_geopackages(input_files, output_file, dissolve_columns=None, explode_parts=False):
+    frames = []
     for file in input_files:
         if os.path.exists(file):
             try:
-                gdf = gpd.read_file(file)
-                if merged is None:
-                    merged = gdf
-                else:
-                    merged = pd.concat([merged, gdf], ignore_index=True)
+                frames.append(read_result(file))
             except Exception as e:
                 print(f"Fout bij lezen van {file}: {e}")
 
-    if merged is not None:
-        merged = gpd.GeoDataFrame(merged, geometry='geometry', crs=merged.crs)
+    if frames:
+        # Eén keer samenvoegen in plaats van per bestand het hele resultaat te kopiëren
+        merged = pd.concat(frames, ignore_index=True, copy=False)
+        merged = gpd.GeoDataFrame(merged, geometry='geometry', crs=frames[0].crs)
 
         if dissolve_columns:
             merged[dissolve_columns] = merged[dissolve_columns].fillna('')
-            merged = merged.dissolve(by=dissolve_columns, as_index=False)
-            merged = merged.explode(ignore_index=True)
+            dissolved = merged.groupby(dissolve_columns, sort=False)['geometry'].agg(union_geometries)
+            merged = gpd.GeoDataFrame(dissolved.reset_index(), geometry='geometry', crs=merged.crs)
 
-        merged['geometry'] = merged['geometry'].buffer(0)
-        merged.to_file(output_file, driver="GPKG")
+        # Multipolygonen blijven standaard behouden; opsplitsen in losse delen alleen als daarom gevraagd wordt
+        if explode_parts:
+            parts, index = shapely.get_parts(merged.geometry.values.to_numpy(), return_index=True)
+            merged = merged.iloc[index].reset_index(drop=True).set_geometry(parts, crs=merged.crs)
+
+        # Herstel alleen de ongeldige geometrieën op dezelfde manier als PublicSpace: alleen de polygonen blijven over,
+        # zodat de laag geen lijnen of punten krijgt
+        geoms = PublicSpace.make_valid(merged.geometry.values.to_numpy())
+        keep = ~shapely.is_missing(geoms) & ~shapely.is_empty(geoms)
+        merged = merged[keep].set_geometry(geoms[keep], crs=merged.crs)
+        pyogrio.write_dataframe(merged, output_file, driver="GPKG")
 
 # Main entry point
 def main():
@@ -86,6 +128,12 @@ def main():
         datefmt='%Y-%m-%d %H:%M:%S'
     )
 
+    # Geen fsync per rij bij het wegschrijven van (grote) GeoPackages en een grotere SQLite-cache (MB). Eenmalig
+    # ingesteld voor het hele proces; de workers erven deze omgeving.
+    os.environ.setdefault('SQLITE_USE_OGR_VFS', 'YES')
+    os.environ.setdefault('OGR_SQLITE_SYNCHRONOUS', 'OFF')
+    os.environ.setdefault('OGR_SQLITE_CACHE', '512')
+
     aoi_name = 'provincie_zeeland'
     aoi_path = fr'../data/input/{aoi_name}.gpkg'
     base_output_path = fr'C:\Temp\publicspace\data\output'
@@ -99,30 +147,57 @@ def main():
             os.remove(path)
 
     aoi_gdf = gpd.read_file(aoi_path)
-    processes = []
-
-    for idx, row in aoi_gdf.iterrows():
-        p = Process(target=run_analysis_for_polygon, args=(idx, row, aoi_gdf.crs, base_output_path, aoi_name))
-        p.start()
-        p.join()  # Sequential. Verwijder voor parallelle verwerking.
-        processes.append(p)
 
-    # Als je parallel wilt draaien, verplaats join() naar hier:
-    # for p in processes:
-    #     p.join()
+    # Elke polygoon is onafhankelijk; verwerk ze parallel met een begrensd aantal workers.
+    # Een worker krijgt alleen de WKB en de attributen van zijn polygoon mee, dat is veel kleiner
+    # dan een gepickelde rij met Shapely-geometrie.
+    idxs = list(aoi_gdf.index)
+    wkbs = shapely.to_wkb(aoi_gdf.geometry.values)
+    attrs = aoi_gdf.drop(columns=aoi_gdf.geometry.name).to_dict('records')
+    max_workers = max(1, (os.cpu_count() or 2) - 1)
+
+    # Elke PublicSpace verwerkt zijn gridcellen in een eigen threadpool. Verdeel de cores over de processen, anders
+    # start elk proces evenveel GEOS-threads als er cores zijn.
+    threads = max(1, (os.cpu_count() or 1) // min(max_workers, max(1, len(idxs))))
+
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {
+            executor.submit(run_analysis_for_polygon, idx, wkb, attr, aoi_gdf.crs, base_output_path, aoi_name,
+                            threads): idx
+            for idx, wkb, attr in zip(idxs, wkbs, attrs)
+        }
+
+        # Een worker die wegvalt (bijvoorbeeld door een tekort aan geheugen) breekt de pool; log dit per polygoon en
+        # voeg daarna de resultaten samen die wel gelukt zijn
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f"[{aoi_name}_area{futures[future]}] FOUT: {e!r}")
 
     # Verzamel alle output-bestanden
     temp_result_files = []
     temp_agg_files = []
 
-    for idx in range(len(aoi_gdf)):
+    # Eén directory listing in plaats van een stat per bestand
+    existing = set(os.listdir(base_output_path)) if os.path.isdir(base_output_path) else set()
+
+    # Voorkeur voor de Arrow IPC-bestanden; GeoPackages van eerdere runs zonder Arrow-uitvoer worden ook meegenomen
+    def find_output(name):
+        for extension in (".arrow", ".gpkg"):
+            if f"{name}{extension}" in existing:
+                return os.path.join(base_output_path, f"{name}{extension}")
+        return None
+
+    for idx in idxs:
         output_id = f"{aoi_name}_area{idx}"
-        export_path = os.path.join(base_output_path, f"{output_id}.gpkg")
-        export_aggregate_path = os.path.join(base_output_path, f"{output_id}_geaggregeerd.gpkg")
-        if os.path.exists(export_path):
-            temp_result_files.append(export_path)
-        if os.path.exists(export_aggregate_path):
-            temp_agg_files.append(export_aggregate_path)
+        result_file = find_output(output_id)
+        agg_file = find_output(f"{output_id}_geaggregeerd")
+        if result_file:
+            temp_result_files.append(result_file)
+        if agg_file:
+            temp_agg_files.append(agg_file)
 
     merge_geopackages(
         temp_result_files,
@@ -1,26 +1,57 @@
 import geopandas as gpd
+import numpy as np
+import orjson
 import os
+import pyogrio
+import shapely
 import requests
-from requests.exceptions import HTTPError, ConnectionError
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from itertools import islice
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException, RetryError
+from urllib3.util.retry import Retry
 import logging
-import time
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 
 logger = logging.getLogger(__name__)
 
+# Constructors used to rebuild the parts of a clipped geometry, by dimension
+MULTI_CONSTRUCTORS = {0: shapely.multipoints, 1: shapely.multilinestrings, 2: shapely.multipolygons}
+
 class OGCFeatureApi:
-    def __init__(self, url, limit=1000):
+    def __init__(self, url, limit=1000, max_workers=8, output_format='fgb'):
         """
         Initialization method of the OGCFeatureApi
         :param url: url of the OGC Feature API, eg https://api.pdok.nl/lv/bgt/ogc/v1
         :param limit: Maximum amount of features to request per page
+        :param max_workers: Maximum amount of pages to request concurrently
+        :param output_format: Preferred encoding of the pages, 'fgb' (FlatGeobuf) or 'json' (GeoJSON). Falls back to
+        'json' when the api does not support FlatGeobuf.
         """
 
         self.bbox = None
+        self.bbox_str = None
         self.mask = None
 
         self.url = url
         self.collections_endpoint = f'{self.url}/collections'
         self.limit = limit
+        self.max_workers = max_workers
+        self.output_format = output_format
+        self.select_properties = True
+        self.select_filter = True
+        self.max_retries = 5
+
+        # Keep-alive session shared by all (concurrent) page requests. Retries with exponential backoff are handled
+        # by urllib3, which waits for the Retry-After header of a 429 or 503 when the server sends one.
+        retry = Retry(total=self.max_retries, backoff_factor=2, status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=retry)
+        self.session = requests.Session()
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
 
         # Retrieve collections
         self.collections = self.get_collections()
@@ -30,7 +61,7 @@ class OGCFeatureApi:
         Return the different collections within the OGC api
         :return: list of dictionaries containing collection information
         """
-        response = requests.get(f'{self.collections_endpoint}?f=json')
+        response = self.session.get(f'{self.collections_endpoint}?f=json')
         response.raise_for_status()
         return response.json()['collections']
 
@@ -43,35 +74,305 @@ class OGCFeatureApi:
         """
         return collection['storageCRS']
 
-    def download(self, output_path, mask=None, snapshot=None):
+    def set_mask(self, mask):
+        """
+        Set the mask used for spatial filtering. The bounding box for the api requests and the prepared mask geometry
+        for clipping are computed once and reused by all collections and downloads.
+        :param mask: GeoDataFrame with masking polygons
+        :return: None
+        """
+        gdf_mask = mask.to_crs('EPSG:4326')
+        self.bbox = gdf_mask.total_bounds
+        self.bbox_str = ','.join(map(str, self.bbox))
+        self.mask = shapely.unary_union(gdf_mask.geometry.values)
+        shapely.prepare(self.mask)
+
+    def download(self, output_path, mask=None, snapshot=None, fields=None, filters=None):
         """
         Download all collections within the api
         :param output_path: Path where the collections will be stored
-        :param mask: GeoDataFrame with masking polygons for spatial filtering
+        :param mask: GeoDataFrame with masking polygons for spatial filtering. If None, the mask set earlier with
+        set_mask is used.
         :param snapshot: Datetime object for temporal filtering
+        :param fields: Dictionary with collection ids as keys and a list of the properties to download as value.
+        Collections that are not in the dictionary are downloaded with all properties.
+        :param filters: Dictionary with collection ids as keys and a CQL2 text filter as value. Collections that are not
+        in the dictionary are downloaded without filter.
         :return:
         """
+        if fields is None:
+            fields = {}
+        if filters is None:
+            filters = {}
 
-        # determine bounding box for api requests
-        self.bbox = None
-        gdf_mask = None
         if mask is not None:
-            gdf_mask = mask.to_crs('EPSG:4326')
-            self.bbox = gdf_mask.total_bounds
-            self.mask = gdf_mask.union_all()
+            self.set_mask(mask)
 
         # iterate over all collections and download
         for collection in self.collections:
-            self.download_collection(collection, output_path, gdf_mask, snapshot=snapshot)
+            self.download_collection(collection, output_path, self.mask, snapshot=snapshot,
+                                     fields=fields.get(collection['id']), cql_filter=filters.get(collection['id']))
+
+    def request_page(self, url, collection_id, params=None):
+        """
+        Request a single page. Connection errors, server errors and rate limiting (429) are retried by the session,
+        other client errors are not.
+        :param url: url of the page
+        :param collection_id: id of the collection, used for logging
+        :param params: optional query parameters
+        :return: Response object, or None if the request failed. Responses with status 400 or 406 (a parameter or
+        the requested output format is not supported) are returned as well, so the caller can decide.
+        """
+        try:
+            response = self.session.get(url, params=params)
+            if response.status_code in (400, 406):
+                return response
+            response.raise_for_status()
+            return response
+        except RetryError as e:
+            logger.error(f"Failed to download {collection_id}, giving up after {self.max_retries} retries: {e}")
+            return None
+        except RequestException as e:
+            logger.error(f"Failed to download {collection_id}: {e}")
+            return None
 
-    def download_collection(self, collection, output_path, mask=None, snapshot=None):
+    def request_pages(self, urls, collection_id):
+        """
+        Request pages concurrently. At most max_workers requests are in flight, so finished pages do not pile up in
+        memory while earlier pages are written. Requests that have not started yet are cancelled when the generator
+        is closed, for example after a failed page.
+        :param urls: urls of the pages
+        :param collection_id: id of the collection, used for logging
+        :return: generator of Response objects (or None for failed requests) in the order of the urls
+        """
+        urls = iter(urls)
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            in_flight = deque(executor.submit(self.request_page, url, collection_id)
+                              for url in islice(urls, self.max_workers))
+            while in_flight:
+                response = in_flight.popleft().result()
+                url = next(urls, None)
+                if url is not None:
+                    in_flight.append(executor.submit(self.request_page, url, collection_id))
+                yield response
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def decode_page(self, response):
+        """
+        Decode the pagination information of a page. FlatGeobuf pages carry it in the Link header, GeoJSON pages in
+        the Link header or the body. The body is only decoded when there is no Link header, the features themselves
+        are parsed by GDAL in read_page.
+        :param response: Response object of the page
+        :return: dictionary with the page contents
+        """
+        if response.status_code != 200:
+            raise RuntimeError(f"Downloadfout: {response.status_code} - {response.text[:1000]}")
+
+        if self.output_format == 'fgb' or response.links:
+            return {
+                'links': [{'rel': rel, 'href': link['url']} for rel, link in response.links.items()],
+                'numberMatched': response.headers.get('OGC-NumberMatched')
+            }
+
+        try:
+            return orjson.loads(response.content)
+        except ValueError as e:
+            raise RuntimeError(
+                f"Kon JSON niet decoderen uit antwoord: {e}\nResponse tekst: {response.text[:1000]}")
+
+    @staticmethod
+    def is_flatgeobuf(response):
+        """
+        Check whether a response contains FlatGeobuf
+        :param response: Response object of the page
+        :return: Boolean
+        """
+        return response.headers.get('Content-Type', '').startswith('application/flatgeobuf')
+
+    @staticmethod
+    def read_page(response, data):
+        """
+        Let GDAL parse the features of a page (GeoJSON or FlatGeobuf) into an Arrow table with WKB geometries,
+        instead of building Shapely objects from feature dicts in Python.
+        :param response: Response object of the page
+        :param data: decoded page contents
+        :return: GeoDataFrame in EPSG:4326, or None if the page contains no features
+        """
+        if 'features' in data and not data['features']:
+            return None
+
+        _, table = pyogrio.read_arrow(response.content)
+        if table.num_rows == 0:
+            return None
+
+        gdf = gpd.GeoDataFrame.from_arrow(table).rename_geometry('geometry')
+        return gdf.set_crs("EPSG:4326", allow_override=True)
+
+    @staticmethod
+    def align_page(gdf, schema):
+        """
+        Align the columns of a page to those of the first page. Attribute types are inferred per page and appended
+        pages are matched to the fields of the GeoPackage layer by position, so order and types have to be the same.
+        :param gdf: GeoDataFrame with the features of the page, or None
+        :param schema: Series with the column names and dtypes of the first page, without the geometry column
+        :return: aligned GeoDataFrame, or None
+        """
+        if gdf is None:
+            return None
+
+        gdf = gdf.reindex(columns=[*schema.index, 'geometry'])
+        for column, dtype in schema.items():
+            # Columns without values (e.g. missing from the page) are written as NULL
+            if gdf[column].dtype != dtype and not gdf[column].isna().all():
+                try:
+                    gdf[column] = gdf[column].astype(dtype)
+                except (TypeError, ValueError):
+                    # Leave the conversion of these values to GDAL, the column is at the right position
+                    logger.warning(f"Unable to convert column {column} to {dtype}")
+        return gdf
+
+    @staticmethod
+    def clip_to_mask(gdf, mask):
+        """
+        Clip a GeoDataFrame to a mask geometry, keeping the geometry type of the input. The spatial index prunes the
+        features outside the mask and the (prepared) mask skips the intersection for features entirely inside it.
+        :param gdf: GeoDataFrame to clip
+        :param mask: Shapely geometry in the crs of gdf
+        :return: clipped GeoDataFrame
+        """
+        gdf = gdf.iloc[np.sort(gdf.sindex.query(mask, predicate='intersects'))]
+
+        original = gdf.geometry.values.to_numpy()
+        geoms = original.copy()
+        crossing = ~shapely.contains_properly(mask, geoms)
+        geoms[crossing] = shapely.intersection(geoms[crossing], mask)
+
+        # Keep only the parts with the dimension of the input, e.g. a polygon touching the mask results in a line
+        dimensions = shapely.get_dimensions(original)
+        collections = np.flatnonzero(shapely.get_type_id(geoms) == shapely.GeometryType.GEOMETRYCOLLECTION)
+        for i in collections:
+            parts = shapely.get_parts(geoms[i])
+            parts = parts[shapely.get_dimensions(parts) == dimensions[i]]
+            geoms[i] = MULTI_CONSTRUCTORS[dimensions[i]](parts) if len(parts) > 0 else None
+
+        keep = ~shapely.is_missing(geoms) & ~shapely.is_empty(geoms) & (shapely.get_dimensions(geoms) == dimensions)
+        return gdf[keep].set_geometry(geoms[keep], crs=gdf.crs)
+
+    @staticmethod
+    def write_page(gdf, output_file, mask=None, append=False):
+        """
+        Write the features of a single page to the output GeoPackage
+        :param gdf: GeoDataFrame with the features of the page in EPSG:4326, or None
+        :param output_file: GeoPackage to write to
+        :param mask: Shapely geometry (EPSG:4326) for clipping the page
+        :param append: Append to the existing layer instead of creating it
+        :return: True if features were written
+        """
+        if gdf is None:
+            return False
+
+        # Clip
+        if mask is not None:
+            gdf = OGCFeatureApi.clip_to_mask(gdf, mask)
+        if gdf.empty:
+            return False
+
+        # Reproject to RD New
+        gdf = gdf.to_crs("EPSG:28992")
+
+        pyogrio.write_dataframe(gdf, output_file, driver="GPKG", promote_to_multi=True, append=append)
+        return True
+
+    @staticmethod
+    def get_next_page_url(data):
+        """
+        Return the url of the next page
+        :param data: decoded page contents
+        :return: url of the next page or None on the last page
+        """
+        return next((link.get('href') for link in data.get('links', []) if link.get('rel') == 'next'), None)
+
+    @staticmethod
+    def is_last_page(page, data):
+        """
+        Check whether a FlatGeobuf page without a link to the next page is really the last one. The api may return
+        fewer features than the requested limit, so the size of the page alone does not tell.
+        :param page: GeoDataFrame with the features of the page, or None
+        :param data: decoded pagination information of the page
+        :return: Boolean
+        """
+        if page is None:
+            return True
+        if data['numberMatched'] is not None:
+            return len(page) >= int(data['numberMatched'])
+        # An api that sends other links (such as self) in the Link header would also send the link to the next page
+        return len(data['links']) > 0
+
+    @staticmethod
+    def get_offset_page_urls(next_page_url, data):
+        """
+        Return the urls of all remaining pages when the api paginates with an offset and reports the number of
+        matched features. Cursor based apis (such as PDOK) return an empty list.
+        :param next_page_url: url of the second page
+        :param data: decoded contents of the first page
+        :return: list of urls
+        """
+        number_matched = data.get('numberMatched')
+        if next_page_url is None or number_matched is None:
+            return []
+
+        parts = urlsplit(next_page_url)
+        query = dict(parse_qsl(parts.query))
+        if 'offset' not in query or 'limit' not in query:
+            return []
+
+        limit = int(query['limit'])
+        urls = []
+        for offset in range(int(query['offset']), int(number_matched), limit):
+            query['offset'] = str(offset)
+            urls.append(urlunsplit(parts._replace(query=urlencode(query))))
+        return urls
+
+    @staticmethod
+    def remove_incomplete(output_file):
+        """
+        Remove a partially written GeoPackage after a failed download
+        :param output_file: GeoPackage to remove
+        :return: None
+        """
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        return None
+
+    def fall_back_to_json(self, collection, output_path, mask, snapshot, fields, cql_filter, reason):
+        """
+        Switch the api to GeoJSON pages and download the collection again
+        :param collection: Dictionary containing the collection information
+        :param output_path: Path where the collection will be stored
+        :param mask: Shapely geometry (EPSG:4326) for clipping the downloaded result
+        :param snapshot: Datetime object for temporal filtering
+        :param fields: List of properties to download
+        :param cql_filter: CQL2 text filter
+        :param reason: String with the reason, used for logging
+        :return: Path of the written GeoPackage, or None if nothing was written
+        """
+        logger.info(f"FlatGeobuf not usable for {self.url} ({reason}), falling back to GeoJSON")
+        self.output_format = 'json'
+        return self.download_collection(collection, output_path, mask, snapshot=snapshot, fields=fields,
+                                        cql_filter=cql_filter)
+
+    def download_collection(self, collection, output_path, mask=None, snapshot=None, fields=None, cql_filter=None):
         """
         Download a collection to GeoPackage
         :param collection: Dictionary containing the collection information
         :param output_path: Path where the collection will be stored
-        :param mask: GeoDataFrame with a mask for clipping the downloaded result
+        :param mask: Shapely geometry (EPSG:4326), preferably prepared, for clipping the downloaded result
         :param snapshot: Datetime object for temporal filtering
-        :return:
+        :param fields: List of properties to download, if None all properties are downloaded
+        :param cql_filter: CQL2 text filter on the properties, if None all features are downloaded
+        :return: Path of the written GeoPackage, or None if nothing was written
         """
 
         collection_id = collection['id']
@@ -81,76 +382,100 @@ class OGCFeatureApi:
             'limit': self.limit,
             'crs': 'http://www.opengis.net/def/crs/OGC/1.3/CRS84',
             'bbox-crs': 'http://www.opengis.net/def/crs/OGC/1.3/CRS84',
-            'bbox': ','.join(map(str, self.bbox))
+            'bbox': self.bbox_str
         }
 
+        # Only request the properties that are used, if the api supports it
+        if fields and self.select_properties:
+            payload['properties'] = ','.join(fields)
+
+        # Only request the features that are used, if the api supports it
+        if cql_filter and self.select_filter:
+            payload['filter'] = cql_filter
+            payload['filter-lang'] = 'cql2-text'
+
         # Add snapshot to payload
         if snapshot:
             payload['datetime'] = snapshot.strftime("%Y-%m-%dT%H:%M:%SZ")
 
         # Build initial url
         url = f'{self.collections_endpoint}/{collection_id}/items'
-        all_features = []
 
-        next_page_url = url
+        if not os.path.exists(output_path):
+            os.makedirs(output_path)
+        output_file = os.path.join(output_path, f'{collection_id}.gpkg')
 
-        try:
-            max_retries = 5
-            retry_wait = 60  # seconden
-
-            # iterate over pages
-            while next_page_url:
-                for attempt in range(max_retries):
-                    try:
-                        if next_page_url == url:
-                            response = requests.get(next_page_url, params=payload)
-                        else:
-                            response = requests.get(next_page_url)
-                        response.raise_for_status()
-                        break  # success
-                    except (HTTPError, ConnectionError) as e:
-                        logger.warning(f"[Attempt {attempt + 1}/{max_retries}] Error for {collection_id}: {e}")
-                        if attempt < max_retries - 1:
-                            time.sleep(retry_wait)
-                        else:
-                            logger.error(f"Failed to download {collection_id} after {max_retries} attempts")
-                            return None
-
-                if response.status_code == 200:
-                    try:
-                        data = response.json()
-                    except ValueError as e:
-                        raise RuntimeError(
-                            f"Kon JSON niet decoderen uit antwoord: {e}\nResponse tekst: {response.text[:1000]}")
-                else:
-                    raise RuntimeError(f"Downloadfout: {response.status_code} - {response.text[:1000]}")
-
-                features = data.get('features', [])
-                all_features.extend(features)
-
-                next_page_url = next((link.get('href') for link in data.get('links', []) if link.get('rel') == 'next'),
-                                     None)
-
-        except HTTPError as e:
-            logger.error(f"HTTPError on collection {collection_id}: {e}")
-            return None
-
-        # Convert the collected features to a GeoDataFrame
-        if len(all_features) > 0:
-            gdf = gpd.GeoDataFrame.from_features(all_features)
-            gdf = gdf.set_crs("EPSG:4326")
-
-            # Clip
-            gdf = gdf.clip(mask=mask, keep_geom_type=True)
+        # Pages are written to the GeoPackage one at a time, so memory use does not depend on the collection size.
+        # The first page with features sets the columns of the layer.
+        pages_written = 0
+        schema = None
 
-            # Reproject to RD New
-            gdf = gdf.to_crs("EPSG:28992")
+        def read_aligned_page(response, data):
+            nonlocal schema
+            page = self.read_page(response, data)
+            if page is not None and schema is None:
+                schema = page.dtypes.drop('geometry')
+            return self.align_page(page, schema)
 
-            if not os.path.exists(output_path):
-                os.makedirs(output_path)
+        # First page, which tells how the api paginates
+        response = self.request_page(url, collection_id, params={**payload, 'f': self.output_format})
+        if response is None:
+            return None
+        if response.status_code == 400 and self.output_format == 'fgb':
+            # Some apis answer an unsupported format with 400 instead of 406, check GeoJSON before blaming the filter
+            # or the properties
+            json_response = self.request_page(url, collection_id, params={**payload, 'f': 'json'})
+            if json_response is None:
+                return None
+            if json_response.status_code != 400:
+                return self.fall_back_to_json(collection, output_path, mask, snapshot, fields, cql_filter,
+                                              "format not supported")
+        if response.status_code == 400 and 'filter' in payload:
+            logger.info(f"Filtering not supported by {self.url}, downloading all features")
+            self.select_filter = False
+            return self.download_collection(collection, output_path, mask, snapshot=snapshot, fields=fields,
+                                            cql_filter=cql_filter)
+        if response.status_code == 400 and 'properties' in payload:
+            logger.info(f"Selecting properties not supported by {self.url}, downloading all properties")
+            self.select_properties = False
+            return self.download_collection(collection, output_path, mask, snapshot=snapshot, fields=fields,
+                                            cql_filter=cql_filter)
+        if self.output_format == 'fgb' and (response.status_code == 406 or
+                                            (response.status_code == 200 and not self.is_flatgeobuf(response))):
+            return self.fall_back_to_json(collection, output_path, mask, snapshot, fields, cql_filter,
+                                          "format not supported")
+        data = self.decode_page(response)
+        page = read_aligned_page(response, data)
+        next_page_url = self.get_next_page_url(data)
+        if self.output_format == 'fgb' and next_page_url is None and not self.is_last_page(page, data):
+            # No link to the next page while the api may have capped the page size, the pagination cannot be followed
+            return self.fall_back_to_json(collection, output_path, mask, snapshot, fields, cql_filter,
+                                          "no pagination links")
+        pages_written += self.write_page(page, output_file, mask, append=pages_written > 0)
 
-            gdf.to_file(os.path.join(output_path, f'{collection_id}.gpkg'))
-            return gdf
+        offset_page_urls = self.get_offset_page_urls(next_page_url, data)
+        if offset_page_urls:
+            # All remaining pages are known upfront, fetch them concurrently
+            with closing(self.request_pages(offset_page_urls, collection_id)) as responses:
+                for response in responses:
+                    if response is None:
+                        return self.remove_incomplete(output_file)
+                    page = read_aligned_page(response, self.decode_page(response))
+                    pages_written += self.write_page(page, output_file, mask, append=pages_written > 0)
 
         else:
+            # Cursor based pagination, follow the links page by page
+            while next_page_url:
+                response = self.request_page(next_page_url, collection_id)
+                if response is None:
+                    return self.remove_incomplete(output_file)
+                data = self.decode_page(response)
+                page = read_aligned_page(response, data)
+                pages_written += self.write_page(page, output_file, mask, append=pages_written > 0)
+                next_page_url = self.get_next_page_url(data)
+
+        if pages_written == 0:
             logger.info(f"No features in {collection_id}, skipping layer")
+            return None
+
+        return output_file
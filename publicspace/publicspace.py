@@ -1,10 +1,15 @@
 import geopandas as gpd
 import pandas as pd
 import pyogrio.errors
-from shapely.errors import GEOSException
+import pyarrow.parquet as pq
+import pyproj
+import shapely
 from shapely.geometry import Polygon, MultiPolygon
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import json
 import logging
+import os
 
 from datetime import datetime
 import numpy as np
@@ -15,7 +20,8 @@ from publicspace.downloaders import OGCFeatureApi
 logger = logging.getLogger(__name__)
 
 from publicspace.settings import TOP10NL_FUNCTIONEELGEBIED_PRIVATE, PRIVATE, PUBLIC, BGT_BEGRTERREINDEEL_PUBLIC, \
-    TOP10NL_FUNCTIONEELGEBIED_HARBOUR, KUNSTWERKDEEL_PUBLIC
+    TOP10NL_FUNCTIONEELGEBIED_HARBOUR, KUNSTWERKDEEL_PUBLIC, BGT_FIELDS, TOP10NL_FIELDS, \
+    TOP10NL_FILTERS, CATEGORY_COLUMNS
 
 
 class PublicSpace:
@@ -27,7 +33,9 @@ class PublicSpace:
                  bgt_download: bool = True,
                  top10nl_layers: dict = None,
                  top10nl_download: bool = True,
-                 aoi: [Polygon, MultiPolygon] = None,
+                 aoi: [gpd.GeoDataFrame, Polygon, MultiPolygon] = None,
+                 max_workers: int = None,
+                 geoparquet: bool = False,
                  ):
 
         """
@@ -39,36 +47,55 @@ class PublicSpace:
         :param bgt_download: Boolean indicating whether to download BGT data.
         :param top10nl_layers: Dictionary of TOP10NL layers to load.
         :param top10nl_download: Boolean indicating whether to download TOP10NL data.
-        :param aoi: Area of interest as a Polygon or MultiPolygon.
+        :param aoi: Area of interest as a GeoDataFrame, or as a Polygon or MultiPolygon in the CRS of the data.
+            Downloading requires a GeoDataFrame.
+        :param max_workers: Maximum number of threads used to process grid cells, defaults to the number of CPUs.
+            When several PublicSpace instances run in parallel processes, divide the CPUs over them instead.
+        :param geoparquet: Boolean indicating whether to convert the BGT and TOP10NL GeoPackages to GeoParquet, so
+            later runs on the same data can read those instead.
         """
 
+        self.max_workers = max_workers or os.cpu_count()
+
         if bgt_download:
             logger.info("Start downloading BGT")
             bgt = OGCFeatureApi('https://api.pdok.nl/lv/bgt/ogc/v1')
             dt = datetime.now()
-            bgt.download(output_path=bgt_path, mask=aoi, snapshot=dt)
+            bgt.download(output_path=bgt_path, mask=aoi, snapshot=dt, fields=BGT_FIELDS)
 
         if top10nl_download:
             logger.info("Start downloading TOP10NL")
             top10nl = OGCFeatureApi('https://api.pdok.nl/brt/top10nl/ogc/v1')
-            top10nl.download(output_path=top10nl_path, mask=aoi)
+            top10nl.download(output_path=top10nl_path, mask=aoi, fields=TOP10NL_FIELDS, filters=TOP10NL_FILTERS)
+
+        if geoparquet:
+            self.convert_to_geoparquet(bgt_path)
+            self.convert_to_geoparquet(top10nl_path)
 
-        self.bgt = self.load_source(bgt_path, bgt_layers)
-        self.top10nl = self.load_source(top10nl_path, top10nl_layers)
+        # Only read the features within the bounding box of the area of interest
+        self.bgt = self.load_source(bgt_path, bgt_layers, fields=BGT_FIELDS, aoi=aoi)
+        self.top10nl = self.load_source(top10nl_path, top10nl_layers, fields=TOP10NL_FIELDS, aoi=aoi)
 
         self.gdf = gpd.GeoDataFrame(columns=['source', 'layer', 'source_id', 'reason', 'source_category', 'category',
                                              'geometry'],
                                     geometry='geometry')
+        # Data waiting to be added to self.gdf, see _materialize
+        self._pending = []
 
         self.analyze_public_private_space(self.bgt, self.top10nl)
+        self._materialize()
 
-    def load_source(self, path: str, layers: dict, filter_geom_type=None):
+    def load_source(self, path: str, layers: dict, filter_geom_type=None, fields: dict = None, aoi=None):
         """
         Load GIS data containing layers. Layers dict should contain file name, layer name and column name information.
 
         :param path: path containing layers
         :param layers: dictionary containing all layer names as keys and the filename as value
         :param filter_geom_type: List of geometry types used as a filter when loading data sources
+        :param fields: Dictionary with file name (without extension) as keys and the list of columns to read as values.
+            Files without an entry are read with all columns.
+        :param aoi: Area of interest as a GeoDataFrame, or as a Polygon or MultiPolygon in the CRS of the data. Only
+            features intersecting its bounding box are read.
         :return: Dictionary object with layer name as keys and GeoDataFrames as values
         """
 
@@ -76,6 +103,9 @@ class PublicSpace:
         if filter_geom_type is None:
             filter_geom_type = ['Polygon', 'MultiPolygon']
 
+        if fields is None:
+            fields = {}
+
         logger.info(f"Start loading dataset in {path}")
 
         # create data dict
@@ -94,13 +124,13 @@ class PublicSpace:
 
             for file in file_list:
                 try:
-                    gdf_item = gpd.read_file(Path(path) / file)
+                    gdf_item = self._read_layer(Path(path) / file, fields.get(Path(file).stem), aoi)
 
                     if filter_geom_type:
                         gdf_item = gdf_item[gdf_item.geom_type.isin(filter_geom_type)]
 
                     if gdf is None:
-                        gdf = gdf_item.copy()
+                        gdf = gdf_item
                     else:
                         gdf = pd.concat([gdf, gdf_item])
                 except pyogrio.errors.DataSourceError as e:
@@ -108,10 +138,101 @@ class PublicSpace:
                                    f"this file won't be created.")
                     continue
 
+            # Columns with a limited set of values are compared as integer codes instead of strings
+            if gdf is not None:
+                gdf = gdf.astype({column: 'category' for column in CATEGORY_COLUMNS if column in gdf.columns})
+
             data[key] = gdf
 
         return data
 
+    @staticmethod
+    def _read_layer(file: Path, columns: list = None, aoi=None):
+        """
+        Read a single layer. A GeoParquet file next to the GeoPackage (see convert_to_geoparquet) is read instead
+        when it is present and not older than the GeoPackage.
+
+        :param file: path to the layer
+        :param columns: list of columns to read, all columns if None
+        :param aoi: area of interest used to filter the features on its bounding box, see _aoi_bounds
+        :return: GeoDataFrame
+        """
+        parquet_file = file.with_suffix('.parquet')
+        if PublicSpace._is_up_to_date(parquet_file, file):
+            schema = pq.read_schema(parquet_file)
+            if columns is not None:
+                # Unlike pyogrio, pyarrow fails on columns that are not present
+                columns = [column for column in columns if column in schema.names] + ['geometry']
+
+            # GeoParquet stores the CRS as PROJJSON, a missing CRS means OGC:CRS84
+            geo = json.loads(schema.metadata[b'geo'])
+            crs = geo['columns'][geo['primary_column']].get('crs', 'OGC:CRS84')
+            if isinstance(crs, dict):
+                crs = pyproj.CRS.from_json_dict(crs)
+            bounds = PublicSpace._aoi_bounds(aoi, crs)
+            gdf = gpd.read_parquet(parquet_file, columns=columns, bbox=bounds)
+            if bounds is not None:
+                # The bbox filter of read_parquet compares the bbox column only, GDAL also drops features whose
+                # geometry does not intersect the bounding box. Filter the same way to get the same features.
+                gdf = gdf[gdf.intersects(shapely.box(*bounds))]
+            return gdf
+
+        crs = pyogrio.read_info(file)['crs']
+        return pyogrio.read_dataframe(file, use_arrow=True, force_2d=True, columns=columns,
+                                      bbox=PublicSpace._aoi_bounds(aoi, crs))
+
+    @staticmethod
+    def _aoi_bounds(aoi, crs):
+        """
+        Helper function to get the bounding box of the area of interest in the CRS of a data source.
+
+        :param aoi: GeoDataFrame or GeoSeries, which is transformed to crs, or a Shapely geometry in the CRS of the
+            data source. If None, no bounding box is returned.
+        :param crs: CRS of the data source, or None if unknown
+        :return: Tuple (minx, miny, maxx, maxy) or None
+        """
+        if aoi is None:
+            return None
+        if isinstance(aoi, (gpd.GeoDataFrame, gpd.GeoSeries)):
+            if crs is not None and aoi.crs is not None:
+                aoi = aoi.to_crs(crs)
+            return tuple(aoi.total_bounds)
+        return aoi.bounds
+
+    @staticmethod
+    def _is_up_to_date(parquet_file: Path, file: Path):
+        """
+        Helper function to check whether a GeoParquet file can be used instead of the GeoPackage it was converted
+        from. A GeoPackage that was downloaded again after the conversion makes the GeoParquet file outdated.
+
+        :param parquet_file: path to the GeoParquet file
+        :param file: path to the GeoPackage
+        :return: Boolean
+        """
+        if not parquet_file.is_file():
+            return False
+        return not file.is_file() or parquet_file.stat().st_mtime >= file.stat().st_mtime
+
+    @staticmethod
+    def convert_to_geoparquet(path: str):
+        """
+        Convert all GeoPackages in path to GeoParquet. Features are sorted along a Hilbert curve and a bbox column is
+        added, so reads filtered on a bounding box can skip row groups outside of it. GeoPackages that already have
+        an up-to-date GeoParquet file are skipped.
+
+        :param path: path containing the GeoPackages
+        """
+        for file in Path(path).glob('*.gpkg'):
+            parquet_file = file.with_suffix('.parquet')
+            if PublicSpace._is_up_to_date(parquet_file, file):
+                continue
+
+            logger.info(f"Converting {file.name} to GeoParquet")
+            gdf = pyogrio.read_dataframe(file, use_arrow=True, force_2d=True)
+            if len(gdf) > 0:
+                gdf = gdf.iloc[gdf.hilbert_distance().argsort()]
+            gdf.to_parquet(parquet_file, index=False, write_covering_bbox=True)
+
     def analyze_public_private_space(self, bgt: dict, top10nl: dict):
         """
         Method that implements a dataflow using different data sources (BGT and TOP10NL) in order to determine what
@@ -125,10 +246,9 @@ class PublicSpace:
         logger.info("Step 1: TOP10NL functioneel gebied of certain categories -> private")
         try:
             top10nl_functioneelgebied = top10nl['functioneelgebied']
-            top10nl_functioneelgebied_selectie = top10nl_functioneelgebied[
-                top10nl_functioneelgebied['typefunctioneelgebied'].isin(TOP10NL_FUNCTIONEELGEBIED_PRIVATE)]
-            self.add_data(data=top10nl_functioneelgebied_selectie,
-
+            self.add_data(data=top10nl_functioneelgebied,
+                          mask=top10nl_functioneelgebied['typefunctioneelgebied'].isin(
+                              TOP10NL_FUNCTIONEELGEBIED_PRIVATE),
                           source='top10nl',
                           layer='functioneelgebied',
                           source_id_column='lokaal_id',
@@ -156,8 +276,8 @@ class PublicSpace:
         logger.info("Step 3: BGT Onbegroeidterreindeel of category 'erf' -> private")
         try:
             bgt_onbegroeidterreindeel = bgt['onbegroeidterreindeel']
-            bgt_obtd_erf = bgt_onbegroeidterreindeel[bgt_onbegroeidterreindeel['fysiek_voorkomen'] == 'erf']
-            self.add_data(data=bgt_obtd_erf,
+            self.add_data(data=bgt_onbegroeidterreindeel,
+                          mask=bgt_onbegroeidterreindeel['fysiek_voorkomen'] == 'erf',
                           source='bgt',
                           layer='onbegroeid_terreindeel',
                           source_id_column='lokaal_id',
@@ -169,12 +289,15 @@ class PublicSpace:
             logger.warning("Geen BGT onbegroeidterreindeel aangetroffen")
 
         # Step 4 BGT Begroeidterreindeel with specific category to public
-        logger.info("Step 4: BGT Begroeidterreindeel of certain categories -> public")
+        # Step 5 BGT Begroeidterreindeel which are not in step 4 to private
         try:
             bgt_begroeidterreindeel = bgt['begroeidterreindeel']
-            bgt_begroeidterreindeel_selectie = bgt_begroeidterreindeel[
-                bgt_begroeidterreindeel['fysiek_voorkomen'].isin(BGT_BEGRTERREINDEEL_PUBLIC)]
-            self.add_data(data=bgt_begroeidterreindeel_selectie,
+            # The selection and its complement are classified in two steps, compute the mask once
+            is_public = bgt_begroeidterreindeel['fysiek_voorkomen'].isin(BGT_BEGRTERREINDEEL_PUBLIC)
+
+            logger.info("Step 4: BGT Begroeidterreindeel of certain categories -> public")
+            self.add_data(data=bgt_begroeidterreindeel,
+                          mask=is_public,
                           source='bgt',
                           layer='begroeid_terreindeel',
                           source_id_column='lokaal_id',
@@ -183,16 +306,10 @@ class PublicSpace:
                           source_category='fysiek_voorkomen',
                           category=PUBLIC
                           )
-        except TypeError:
-            logger.warning("Geen BGT begroeidterreindeel aangetroffen")
 
-        # Step 5 BGT Begroeidterreindeel which are not in step 4 to private
-        logger.info("Step 5: BGT Begroeidterreindeel of certain categories -> private")
-        try:
-            bgt_begroeidterreindeel = bgt['begroeidterreindeel']
-            bgt_begroeidterreindeel_overig = bgt_begroeidterreindeel[
-                ~bgt_begroeidterreindeel['fysiek_voorkomen'].isin(BGT_BEGRTERREINDEEL_PUBLIC)]
-            self.add_data(data=bgt_begroeidterreindeel_overig,
+            logger.info("Step 5: BGT Begroeidterreindeel of certain categories -> private")
+            self.add_data(data=bgt_begroeidterreindeel,
+                          mask=~is_public,
                           source='bgt',
                           layer='begroeid_terreindeel',
                           source_id_column='lokaal_id',
@@ -205,12 +322,15 @@ class PublicSpace:
             logger.warning("Geen BGT begroeidterreindeel aangetroffen")
 
         # Step 6 BGT Wegdeel for which functie = spoorbaan to private
-        logger.info("Step 6: BGT wegdeel with category 'spoorbaan' -> private")
+        # Step 7 All BGT Wegdeel which are not in step 6 to public
         try:
             bgt_wegdeel = bgt['wegdeel']
-            bgt_wegdeel_spoorbaan = bgt_wegdeel[
-                bgt_wegdeel['functie'] == 'spoorbaan']
-            self.add_data(data=bgt_wegdeel_spoorbaan,
+            # The selection and its complement are classified in two steps, compute the mask once
+            is_spoorbaan = bgt_wegdeel['functie'] == 'spoorbaan'
+
+            logger.info("Step 6: BGT wegdeel with category 'spoorbaan' -> private")
+            self.add_data(data=bgt_wegdeel,
+                          mask=is_spoorbaan,
                           source='bgt',
                           layer='wegdeel',
                           source_id_column='lokaal_id',
@@ -218,16 +338,10 @@ class PublicSpace:
                           source_category='functie',
                           category=PRIVATE
                           )
-        except TypeError:
-            logger.warning("Geen BGT wegdeel aangetroffen")
 
-        # Step 7 All BGT Wegdeel which are not in step 6 to public
-        logger.info("Step 7: BGT wegdeel with other categories -> public")
-        try:
-            bgt_wegdeel = bgt['wegdeel']
-            bgt_wegdeel_overig = bgt_wegdeel[
-                bgt_wegdeel['functie'] != 'spoorbaan']
-            self.add_data(data=bgt_wegdeel_overig,
+            logger.info("Step 7: BGT wegdeel with other categories -> public")
+            self.add_data(data=bgt_wegdeel,
+                          mask=~is_spoorbaan,
                           source='bgt',
                           layer='wegdeel',
                           source_id_column='lokaal_id',
@@ -302,9 +416,9 @@ class PublicSpace:
         logger.info("Step 13: TOP10NL functioneel gebied 'haven' -> private")
         try:
             top10nl_functioneelgebied = top10nl['functioneelgebied']
-            top10nl_functioneelgebied_harbour = top10nl_functioneelgebied[
-                top10nl_functioneelgebied['typefunctioneelgebied'].isin(TOP10NL_FUNCTIONEELGEBIED_HARBOUR)]
-            self.add_data(data=top10nl_functioneelgebied_harbour,
+            self.add_data(data=top10nl_functioneelgebied,
+                          mask=top10nl_functioneelgebied['typefunctioneelgebied'].isin(
+                              TOP10NL_FUNCTIONEELGEBIED_HARBOUR),
                           source='top10nl',
                           layer='functioneelgebied',
                           source_id_column='lokaal_id',
@@ -318,8 +432,8 @@ class PublicSpace:
         # Step 14 BGT Onbegroeidterreindeel of which fysiek voorkomen =/ erf to public
         logger.info("Step 14: BGT Onbegroeidterreindeel of category other than 'erf' -> public")
         try:
-            bgt_obtd_overig = bgt_onbegroeidterreindeel[bgt_onbegroeidterreindeel['fysiek_voorkomen'] != 'erf']
-            self.add_data(data=bgt_obtd_overig,
+            self.add_data(data=bgt_onbegroeidterreindeel,
+                          mask=bgt_onbegroeidterreindeel['fysiek_voorkomen'] != 'erf',
                           source='bgt',
                           layer='onbegroeid_terreindeel',
                           source_id_column='lokaal_id',
@@ -332,11 +446,15 @@ class PublicSpace:
             logger.warning("Geen BGT onbegroeidterreindeel aangetroffen")
 
         # Step 15 BGT kunstwerkdeel of category 'perron' to public
-        logger.info("Step 15: BGT kunstwerkdeel of category 'perron' to public")
+        # Step 16 Other BGT kunstwerkdeel (not of category 'perron') to private
         try:
             bgt_kunstwerkdeel = bgt["kunstwerkdeel"]
-            bgt_kunstwerkdeel_public = bgt_kunstwerkdeel[bgt_kunstwerkdeel['type'].isin(KUNSTWERKDEEL_PUBLIC)]
-            self.add_data(data=bgt_kunstwerkdeel_public,
+            # The selection and its complement are classified in two steps, compute the mask once
+            is_public = bgt_kunstwerkdeel['type'].isin(KUNSTWERKDEEL_PUBLIC)
+
+            logger.info("Step 15: BGT kunstwerkdeel of category 'perron' to public")
+            self.add_data(data=bgt_kunstwerkdeel,
+                          mask=is_public,
                           source='bgt',
                           layer='kunstwerkdeel',
                           source_id_column='lokaal_id',
@@ -345,15 +463,10 @@ class PublicSpace:
                           source_category='type',
                           category=PUBLIC
                           )
-        except TypeError:
-            logger.warning("Geen BGT kunstwerkdeel aangetroffen")
 
-        # Step 16 Other BGT kunstwerkdeel (not of category 'perron') to private
-        logger.info("Step 16: BGT kunstwerkdeel of other categories to private")
-        try:
-            bgt_kunstwerkdeel = bgt["kunstwerkdeel"]
-            bgt_kunstwerkdeel_private = bgt_kunstwerkdeel[~bgt_kunstwerkdeel['type'].isin(KUNSTWERKDEEL_PUBLIC)]
-            self.add_data(data=bgt_kunstwerkdeel_private,
+            logger.info("Step 16: BGT kunstwerkdeel of other categories to private")
+            self.add_data(data=bgt_kunstwerkdeel,
+                          mask=~is_public,
                           source='bgt',
                           layer='kunstwerkdeel',
                           source_id_column='lokaal_id',
@@ -381,7 +494,8 @@ class PublicSpace:
             logger.warning("Geen BGT overbruggingsdeel aangetroffen")
 
 
-    def add_data(self, data: gpd.GeoDataFrame, source: str, layer, source_id_column, reason, source_category, category):
+    def add_data(self, data: gpd.GeoDataFrame, source: str, layer, source_id_column, reason, source_category, category,
+                 mask: pd.Series = None):
         """
         Adds data to the resulting GeoDataFrame (self.gdf). Makes sure that area that overlaps with already
         classified area cannot be added again.
@@ -392,54 +506,143 @@ class PublicSpace:
         :param reason: String with the reason for classification
         :param source_category: String with the column name in which a filter category was stored
         :param category: String with resulting class
+        :param mask: Boolean Series selecting the rows of data which need to be added, all rows if None
         :return: Added data
         """
 
-        logger.debug("Create buffer to fix geometries")
-        self.gdf['geometry'] = self.gdf['geometry'].buffer(0)
         if data is not None:
-            if not self.gdf.empty and not data.empty:
-                # Define grid size
-                grid_size = 1000
+            # Select the rows and the columns that are used at once, instead of copying the whole layer
+            columns = [source_id_column] + ([source_category] if source_category else []) + [data.geometry.name]
+            data = data.loc[mask, columns] if mask is not None else data[columns]
+
+            # Fix invalid geometries on entry. The result only receives repaired data and the output of GEOS
+            # overlays, so it does not need to be fixed again on every step.
+            logger.debug("Fix invalid geometries")
+            data = data.set_geometry(self.make_valid(data.geometry.values.to_numpy()), crs=data.crs)
 
-                # Create grid
-                xmin, ymin, xmax, ymax = data.total_bounds
-                x_coords = np.arange(xmin, xmax, grid_size)
-                y_coords = np.arange(ymin, ymax, grid_size)
-                grid = [Polygon([(x, y), (x + grid_size, y), (x + grid_size, y + grid_size), (x, y + grid_size)]) for x in
-                        x_coords for y in y_coords]
+            # The overlap with previous steps is removed for all steps at once, see _materialize
+            self._add_processed_data(data, source, layer, source_id_column, reason, source_category, category)
 
-                # Clean up data
-                data.loc[:, 'geometry'] = data['geometry'].buffer(0)
+            return data
 
-                # Process each grid cell with a progress bar
-                for cell in tqdm(grid, desc="Processing grid cells"):
-                    covered_area = self.gdf[self.gdf.intersects(cell)].unary_union
-                    try:
-                        data_in_cell = data.clip(cell).copy()
+    @staticmethod
+    def _create_grid(bounds, grid_size=1000):
+        """
+        Helper function to create a grid of square cells covering the bounds.
 
-                    except GEOSException:
-                        raise
+        :param bounds: Tuple with the bounds (xmin, ymin, xmax, ymax) to cover.
+        :param grid_size: Size of a grid cell.
+        :return: Array with the grid cells as Polygons.
+        """
+        xmin, ymin, xmax, ymax = bounds
+        x_coords = np.arange(xmin, xmax, grid_size)
+        y_coords = np.arange(ymin, ymax, grid_size)
+        xs, ys = np.meshgrid(x_coords, y_coords, indexing='ij')
+        origins = np.stack([xs.ravel(), ys.ravel()], axis=-1)
+        ring = np.array([(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)]) * grid_size
+        return shapely.polygons(origins[:, np.newaxis, :] + ring)
+
+    @staticmethod
+    def _group_by_cell(cell_idx, other_idx, n_cells):
+        """
+        Helper function to group the result of a bulk spatial index query by grid cell.
 
+        :param cell_idx: Array with the index of the grid cell of each pair.
+        :param other_idx: Array with the index of the intersecting geometry of each pair.
+        :param n_cells: Number of grid cells.
+        :return: List with per grid cell an array of indices of intersecting geometries.
+        """
+        order = np.argsort(cell_idx, kind='stable')
+        cell_bounds = np.searchsorted(cell_idx[order], np.arange(n_cells + 1))
+        return np.split(other_idx[order], cell_bounds[1:-1])
 
-                    data_in_cell = data_in_cell[data_in_cell.geom_type.isin(['Polygon','MultiPolygon'])]
-                    data_in_cell['geometry'] = data_in_cell['geometry'].difference(covered_area)
+    @staticmethod
+    def _process_cell(cell, data_in_cell, covered):
+        """
+        Helper function to clip data to a grid cell and classify it in order of priority. Each step only keeps the
+        area that is not already classified, either before or by a step with a lower priority.
 
-                    # Remove empty geometries
-                    data_in_cell = data_in_cell[~data_in_cell.is_empty].copy()
+        :param cell: Polygon of the grid cell.
+        :param data_in_cell: GeoDataFrame with the data intersecting the grid cell, with a 'priority' column.
+        :param covered: Array with the already classified geometries intersecting the grid cell.
+        :return: GeoDataFrame with the remaining data in the grid cell.
+        """
+        data_in_cell = data_in_cell.clip(cell)
+        data_in_cell = data_in_cell[data_in_cell.geom_type.isin(['Polygon', 'MultiPolygon'])]
+
+        geoms = data_in_cell.geometry.values.to_numpy()
+        priorities = data_in_cell['priority'].to_numpy()
+
+        # Candidate pairs from a single query: the classified area is only used to subtract it from later steps, so
+        # only the geometries that intersect the data of a later step have to be merged into it. Geometries that do
+        # not intersect any earlier step or classified geometry are kept as is.
+        tree = shapely.STRtree(geoms)
+        covered_idx, overlapped_idx = tree.query(covered, predicate='intersects')
+        covered = covered[np.unique(covered_idx)]
+        left, right = tree.query(geoms, predicate='intersects')
+        earlier = priorities[right] < priorities[left]
+        needed = np.zeros(len(geoms), dtype=bool)
+        needed[right[earlier]] = True
+        overlapped = np.zeros(len(geoms), dtype=bool)
+        overlapped[left[earlier]] = True
+        overlapped[overlapped_idx] = True
+
+        covered_area = shapely.unary_union(covered)
+        remaining = np.empty_like(geoms)
+        for priority in np.unique(priorities):
+            step = priorities == priority
+            step_geoms = geoms[step]
+
+            # Only run the difference for geometries that partly overlap the classified area, geometries within it
+            # are removed
+            overlapping = overlapped[step]
+            if overlapping.any():
+                shapely.prepare(covered_area)
+                contained = np.zeros_like(overlapping)
+                contained[overlapping] = shapely.contains(covered_area, step_geoms[overlapping])
+                overlapping &= ~contained
+                step_geoms[contained] = Polygon()
+                step_geoms[overlapping] = shapely.difference(step_geoms[overlapping], covered_area)
+            remaining[step] = step_geoms
+
+            # Accumulate the classified area instead of merging all previous results again for every step
+            if (step & needed).any():
+                covered_area = shapely.union(covered_area, shapely.union_all(geoms[step & needed]))
+
+        data_in_cell = data_in_cell.set_geometry(remaining, crs=data_in_cell.crs)
+
+        # Remove empty geometries
+        return data_in_cell[~data_in_cell.is_empty]
 
-                    # Add processed data to self.gdf
-                    self._add_processed_data(data_in_cell, source, layer, source_id_column, reason, source_category,
-                                             category)
-            else:
-                logger.debug("self.gdf is empty, adding data directly")
-                self._add_processed_data(data, source, layer, source_id_column, reason, source_category, category)
+    @staticmethod
+    def make_valid(geoms):
+        """
+        Repair invalid geometries with make_valid. Only the invalid geometries are repaired, and only their polygonal
+        parts are kept. A geometry without polygonal parts becomes an empty Polygon.
 
-            return data
+        :param geoms: Array of Shapely geometries.
+        :return: Array of valid Shapely geometries.
+        """
+        geoms = geoms.copy()
+        invalid = ~shapely.is_valid(geoms) & ~shapely.is_missing(geoms)
+        if invalid.any():
+            fixed = shapely.make_valid(geoms[invalid])
+
+            # make_valid can return lines or points, or a GeometryCollection with lines or points next to the polygons
+            collections = shapely.get_type_id(fixed) == shapely.GeometryType.GEOMETRYCOLLECTION
+            for i in np.flatnonzero(collections):
+                parts = shapely.get_parts(fixed[i])
+                polygons = parts[shapely.get_dimensions(parts) == 2]
+                fixed[i] = shapely.union_all(polygons) if len(polygons) > 0 else Polygon()
+            fixed[shapely.get_dimensions(fixed) < 2] = Polygon()
+
+            geoms[invalid] = fixed
+        return geoms
 
     def _add_processed_data(self, data, source, layer, source_id_column, reason, source_category, category):
         """
-        Helper function to add processed data to self.gdf.
+        Helper function to label data and queue it to be added to self.gdf. The order in which data is added sets
+        its priority.
 
         :param data: GeoDataFrame containing the data to be added.
         :param source: String with the name of the source.
@@ -450,28 +653,62 @@ class PublicSpace:
         :param category: String with the resulting class.
         """
 
-        data = data.copy()
         if not data.empty:
-            data.loc[:, 'source_id'] = data[source_id_column]
-
-            # Add supplied data
-            data.loc[:, 'source'] = source
-            data.loc[:, 'layer'] = layer
-            data.loc[:, 'reason'] = reason
-
-            if source_category:
-                data.loc[:, 'source_category'] = data[source_category]
-            else:
-                data.loc[:, 'source_category'] = None
-
-            data.loc[:, 'category'] = category
-
-            # Reorganize columns to match
-            data = data[list(self.gdf.columns)]
-
-            # Concatenate to PublicSpace GeoDataFrame
-            logger.debug("Add new data to result")
-            self.gdf = pd.concat([self.gdf, data])
+            # Add supplied data in a single step and reorganize columns to match
+            data = data.assign(source_id=data[source_id_column],
+                               source=source,
+                               layer=layer,
+                               reason=reason,
+                               source_category=data[source_category].astype(object) if source_category else None,
+                               category=category)[list(self.gdf.columns)]
+
+            logger.debug("Queue new data")
+            self._pending.append(data)
+
+    def _materialize(self):
+        """
+        Helper function to add all queued data to self.gdf at once. Data is added in the order in which it was queued,
+        without the area that is already classified. Instead of repeating this for every step, all steps are
+        processed together per grid cell.
+        """
+        if not self._pending:
+            return
+
+        crs = next((data.crs for data in self._pending if data.crs is not None), self.gdf.crs)
+        candidates = gpd.GeoDataFrame(
+            pd.concat([data.assign(priority=i) for i, data in enumerate(self._pending)], ignore_index=True),
+            geometry='geometry', crs=crs)
+        self._pending.clear()
+
+        grid = self._create_grid(candidates.total_bounds)
+
+        # Candidates per grid cell, from bulk queries on the queued data and on the area that is already classified.
+        # Grid cells do not overlap, so the cells can be processed independently.
+        data_per_cell = self._group_by_cell(
+            *shapely.STRtree(candidates.geometry.values).query(grid, predicate='intersects'), len(grid))
+        # Nothing is classified on the first call, so no spatial index has to be built. Afterwards self.gdf is only
+        # replaced, never modified, so its cached sindex stays valid until new rows are added.
+        classified = self.gdf.geometry.values.to_numpy()
+        if len(classified) > 0:
+            covered_per_cell = self._group_by_cell(*self.gdf.sindex.query(grid, predicate='intersects'), len(grid))
+        else:
+            covered_per_cell = [np.empty(0, dtype=np.intp)] * len(grid)
+        cells = [i for i in range(len(grid)) if len(data_per_cell[i]) > 0]
+
+        def process_cell(i):
+            return self._process_cell(grid[i], candidates.iloc[np.sort(data_per_cell[i])],
+                                      classified[covered_per_cell[i]])
+
+        # Shapely releases the GIL in GEOS operations, so the cells are processed in parallel threads
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            processed = list(tqdm(executor.map(process_cell, cells), total=len(cells),
+                                  desc="Processing grid cells"))
+
+        if processed:
+            processed = pd.concat(processed, ignore_index=True, copy=False)
+            processed = processed.sort_values('priority', kind='stable').drop(columns='priority')
+            self.gdf = gpd.GeoDataFrame(pd.concat([self.gdf, processed], ignore_index=True, copy=False),
+                                        geometry='geometry', crs=crs)
 
     @staticmethod
     def merge_tiled_data(tiled_data):
@@ -482,14 +719,16 @@ class PublicSpace:
         :return: GeoDataFrame with the merged data.
         """
 
-        gdf = tiled_data.copy()
-        dissolve_columns = gdf.columns.drop('geometry').tolist()
+        dissolve_columns = tiled_data.columns.drop('geometry').tolist()
+        gdf = tiled_data.fillna({column: '' for column in dissolve_columns})
 
-        gdf[dissolve_columns] = gdf[dissolve_columns].fillna('')
+        # Merge the geometries per group directly on the geometry array instead of using dissolve
+        groups = list(gdf.groupby(dissolve_columns, sort=False).indices.values())
+        geoms = gdf.geometry.values.to_numpy()
+        merged = [shapely.union_all(geoms[idx]) for idx in groups]
 
-        # Dissolve based on the specified columns
-        gdf_dissolved = gdf.dissolve(by=dissolve_columns, as_index=False)
-        return gdf_dissolved
+        attributes = gdf[dissolve_columns].iloc[[idx[0] for idx in groups]].reset_index(drop=True)
+        return gpd.GeoDataFrame(attributes, geometry=merged, crs=gdf.crs)
 
     def export(self, filename):
         """
@@ -499,6 +738,7 @@ class PublicSpace:
         :return: None
         """
 
+        self._materialize()
         self.gdf = self.merge_tiled_data(self.gdf)
         self.gdf.to_file(filename)
 
@@ -508,9 +748,16 @@ class PublicSpace:
 
         :param filename: String with filename
         :param aggregate_on: List with column names on which to aggregate.
-        :return: None
+        :return: GeoDataFrame with the aggregate results
         """
         if aggregate_on is None:
             aggregate_on = ['category']
-        aggregate = self.gdf.copy().dissolve(by=aggregate_on, as_index=False).explode()
-        aggregate.to_file(filename)
+        self._materialize()
+        aggregate = self.gdf.dissolve(by=aggregate_on, as_index=False)
+
+        # Split the merged geometries into their parts on the geometry array
+        parts, index = shapely.get_parts(aggregate.geometry.values.to_numpy(), return_index=True)
+        aggregate = aggregate.iloc[index].reset_index(drop=True).set_geometry(parts, crs=aggregate.crs)
+
+        pyogrio.write_dataframe(aggregate, filename, use_arrow=True)
+        return aggregate
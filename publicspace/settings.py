@@ -16,7 +16,27 @@ TOP10NL_LAYERS = {
     'functioneelgebied': ['functioneel_gebied_vlak.gpkg', 'functioneel_gebied_multivlak.gpkg']
 }
 
-TOP10NL_FUNCTIONEELGEBIED_PRIVATE = [
+# Properties per collection that are used in the analysis, only these are downloaded
+BGT_FIELDS = {
+    'onbegroeidterreindeel': ['lokaal_id', 'fysiek_voorkomen'],
+    'begroeidterreindeel': ['lokaal_id', 'fysiek_voorkomen'],
+    'pand': ['lokaal_id'],
+    'wegdeel': ['lokaal_id', 'functie'],
+    'waterdeel': ['lokaal_id', 'type'],
+    'ondersteunendwaterdeel': ['lokaal_id', 'type'],
+    'ondersteunendwegdeel': ['lokaal_id', 'fysiek_voorkomen'],
+    'overigbouwwerk': ['lokaal_id', 'type'],
+    'scheiding_vlak': ['lokaal_id', 'type'],
+    'kunstwerkdeel_vlak': ['lokaal_id', 'type'],
+    'overbruggingsdeel': ['lokaal_id', 'type_overbruggingsdeel']
+}
+
+TOP10NL_FIELDS = {
+    'functioneel_gebied_vlak': ['lokaal_id', 'typefunctioneelgebied'],
+    'functioneel_gebied_multivlak': ['lokaal_id', 'typefunctioneelgebied']
+}
+
+TOP10NL_FUNCTIONEELGEBIED_PRIVATE = frozenset({
     'attractiepark',
     'botanische tuin',
     'bungalowpark',
@@ -66,14 +86,26 @@ TOP10NL_FUNCTIONEELGEBIED_PRIVATE = [
     'zuiveringsinstallatie',
     'zweefvliegveldterrein',
     'zwembadcomplex',
-]
+})
 
-TOP10NL_FUNCTIONEELGEBIED_HARBOUR = ['haven']
+TOP10NL_FUNCTIONEELGEBIED_HARBOUR = frozenset({'haven'})
 
-BGT_BEGRTERREINDEEL_PUBLIC = ['gemengd bos', 'grasland overig', 'groenvoorziening', 'heide', 'houtwal', 'loofbos',
-                              'naaldbos', 'rietland', 'struiken']
+BGT_BEGRTERREINDEEL_PUBLIC = frozenset({'gemengd bos', 'grasland overig', 'groenvoorziening', 'heide', 'houtwal',
+                                        'loofbos', 'naaldbos', 'rietland', 'struiken'})
+
+KUNSTWERKDEEL_PUBLIC = frozenset({'perron'})
+
+# Filters per collection on the features that are used in the analysis, only these are downloaded
+_TOP10NL_FUNCTIONEELGEBIED_USED = ', '.join(
+    "'" + value.replace("'", "''") + "'"
+    for value in sorted(TOP10NL_FUNCTIONEELGEBIED_PRIVATE | TOP10NL_FUNCTIONEELGEBIED_HARBOUR))
+TOP10NL_FILTERS = {
+    'functioneel_gebied_vlak': f'typefunctioneelgebied IN ({_TOP10NL_FUNCTIONEELGEBIED_USED})',
+    'functioneel_gebied_multivlak': f'typefunctioneelgebied IN ({_TOP10NL_FUNCTIONEELGEBIED_USED})'
+}
 
-KUNSTWERKDEEL_PUBLIC = ['perron']
+# Columns with a limited set of values, loaded as categorical
+CATEGORY_COLUMNS = ('fysiek_voorkomen', 'typefunctioneelgebied', 'functie', 'type', 'type_overbruggingsdeel')
 
 PRIVATE = 'privaat'
 PUBLIC = 'publiek'
\ No newline at end of file
@@ -15,6 +15,8 @@ setup(name='publicspace',
         'geopandas~=1.0.1',
         'pandas~=2.2.3',
         'pyogrio~=0.10.0',
+        'pyarrow>=15.0.0',
+        'orjson>=3.9.0',
         'shapely~=2.0.6',
         'numpy~=2.1.2',
         'tqdm~=4.66.5',
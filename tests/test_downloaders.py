@@ -0,0 +1,191 @@
+import io
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import geopandas as gpd
+import pyogrio
+import pytest
+from shapely.geometry import box
+
+from publicspace import downloaders
+from publicspace.downloaders import OGCFeatureApi
+
+FEATURE_COUNT = 25
+
+# Features of the mock api that intersect the mask
+EXPECTED_IDS = sorted(f'id{i}' for i in range(FEATURE_COUNT) if i % 5 < 4 and i < 20)
+
+
+def make_feature(i):
+    x = 3.6 + (i % 5) * 0.001
+    y = 51.5 + (i // 5) * 0.001
+    return {
+        'type': 'Feature',
+        'id': str(i),
+        'properties': {'lokaal_id': f'id{i}', 'fysiek_voorkomen': None if i < 10 else 'erf'},
+        'geometry': {'type': 'Polygon',
+                     'coordinates': [[[x, y], [x + 0.0008, y], [x + 0.0008, y + 0.0008], [x, y + 0.0008], [x, y]]]}
+    }
+
+
+class MockApiHandler(BaseHTTPRequestHandler):
+    """
+    Minimal OGC API Features with a single collection 'pand'. The behaviour is set through attributes of the server:
+    pagination ('cursor' or 'offset'), formats (supported values of f), unsupported_format_status (status for other
+    formats), json_link_header (send the pagination of GeoJSON pages in the Link header) and supported_parameters
+    (optional parameters that are accepted, others give a 400).
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, status, content_type, body, links=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        for rel, href in (links or {}).items():
+            self.send_header('Link', f'<{href}>; rel="{rel}"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        parts = urlsplit(self.path)
+        query = dict(parse_qsl(parts.query))
+
+        if parts.path.endswith('/collections'):
+            self.send_body(200, 'application/json', json.dumps({'collections': [{'id': 'pand'}]}).encode())
+            return
+
+        server.requests.append(query)
+        output_format = query.get('f', 'json')
+        if output_format not in server.formats:
+            self.send_body(server.unsupported_format_status, 'text/plain', b'unsupported format')
+            return
+        if any(parameter in query for parameter in {'properties', 'filter'} - server.supported_parameters):
+            self.send_body(400, 'text/plain', b'unknown parameter')
+            return
+
+        limit = int(query['limit'])
+        start = int(query.get(server.pagination, 0))
+        if start in server.errors:
+            self.send_body(server.errors[start], 'text/plain', b'error')
+            return
+        features = [make_feature(i) for i in range(start, min(FEATURE_COUNT, start + limit))]
+        links = {'self': f'http://127.0.0.1:{server.server_port}{self.path}'}
+        if start + limit < FEATURE_COUNT:
+            next_query = {**query, server.pagination: start + limit}
+            links['next'] = f'http://127.0.0.1:{server.server_port}{parts.path}?{urlencode(next_query)}'
+
+        if output_format == 'fgb':
+            body = io.BytesIO()
+            pyogrio.write_dataframe(gpd.GeoDataFrame.from_features(features, crs='EPSG:4326'), body,
+                                    driver='FlatGeobuf')
+            self.send_body(200, 'application/flatgeobuf', body.getvalue(), links)
+            return
+
+        collection = {'type': 'FeatureCollection', 'features': features}
+        if server.pagination == 'offset':
+            collection['numberMatched'] = FEATURE_COUNT
+        if server.json_link_header:
+            self.send_body(200, 'application/geo+json', json.dumps(collection).encode(), links)
+        else:
+            collection['links'] = [{'rel': rel, 'href': href} for rel, href in links.items()]
+            self.send_body(200, 'application/geo+json', json.dumps(collection).encode())
+
+
+@pytest.fixture
+def mock_api():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MockApiHandler)
+    server.pagination = 'cursor'
+    server.formats = {'json', 'fgb'}
+    server.unsupported_format_status = 406
+    server.json_link_header = False
+    server.supported_parameters = {'properties', 'filter'}
+    server.errors = {}
+    server.requests = []
+    server.url = f'http://127.0.0.1:{server.server_port}'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def mask():
+    return gpd.GeoDataFrame(geometry=[box(3.6, 51.5, 3.6035, 51.5035)], crs='EPSG:4326')
+
+
+def download(server, output_path, mask, output_format='fgb', **kwargs):
+    api = OGCFeatureApi(server.url, limit=10, output_format=output_format)
+    api.download(str(output_path), mask=mask, **kwargs)
+    return api, pyogrio.read_dataframe(os.path.join(output_path, 'pand.gpkg'))
+
+
+def test_json_pagination_from_link_header(mock_api, mask, tmp_path, monkeypatch):
+    # The body of a GeoJSON page is only parsed by GDAL when the pagination is in the Link header
+    mock_api.json_link_header = True
+    monkeypatch.setattr(downloaders.orjson, 'loads', lambda content: pytest.fail('GeoJSON body decoded'))
+
+    _, gdf = download(mock_api, tmp_path, mask, output_format='json')
+
+    assert len(mock_api.requests) == 3
+    assert sorted(gdf['lokaal_id']) == EXPECTED_IDS
+
+
+def test_offset_pages_requested_concurrently(mock_api, mask, tmp_path, monkeypatch):
+    mock_api.pagination = 'offset'
+    concurrent_urls = []
+    request_pages = OGCFeatureApi.request_pages
+
+    def record_request_pages(self, urls, collection_id):
+        concurrent_urls.extend(urls)
+        return request_pages(self, urls, collection_id)
+
+    monkeypatch.setattr(OGCFeatureApi, 'request_pages', record_request_pages)
+
+    _, gdf = download(mock_api, tmp_path, mask, output_format='json')
+
+    # The urls of the remaining pages are built from numberMatched instead of following the links
+    assert [dict(parse_qsl(urlsplit(url).query))['offset'] for url in concurrent_urls] == ['10', '20']
+    assert sorted(int(query.get('offset', 0)) for query in mock_api.requests) == [0, 10, 20]
+    assert sorted(gdf['lokaal_id']) == EXPECTED_IDS
+
+
+def test_failed_offset_page_removes_output(mock_api, mask, tmp_path):
+    mock_api.pagination = 'offset'
+    mock_api.errors = {10: 404}
+
+    api = OGCFeatureApi(mock_api.url, limit=10, output_format='json')
+    api.download(str(tmp_path), mask=mask)
+
+    assert not os.path.exists(os.path.join(tmp_path, 'pand.gpkg'))
+
+
+def test_format_rejected_with_400_falls_back_to_json(mock_api, mask, tmp_path):
+    mock_api.formats = {'json'}
+    mock_api.unsupported_format_status = 400
+
+    api, gdf = download(mock_api, tmp_path, mask, fields={'pand': ['lokaal_id']},
+                        filters={'pand': "fysiek_voorkomen = 'erf'"})
+
+    # The filter and the properties are supported, only the format is not
+    assert api.output_format == 'json'
+    assert api.select_filter and api.select_properties
+    assert all('filter' in query and 'properties' in query for query in mock_api.requests)
+    assert sorted(gdf['lokaal_id']) == EXPECTED_IDS
+
+
+def test_unsupported_properties_keep_flatgeobuf(mock_api, mask, tmp_path):
+    mock_api.supported_parameters = {'filter'}
+    mock_api.unsupported_format_status = 400
+
+    api, gdf = download(mock_api, tmp_path, mask, fields={'pand': ['lokaal_id']})
+
+    assert api.output_format == 'fgb'
+    assert not api.select_properties
+    assert [query['f'] for query in mock_api.requests] == ['fgb', 'json', 'fgb', 'fgb', 'fgb']
+    assert sorted(gdf['lokaal_id']) == EXPECTED_IDS
@@ -0,0 +1,153 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyogrio
+import pytest
+import shapely
+from shapely import affinity
+from shapely.geometry import LineString, Polygon, box
+
+from publicspace.publicspace import PublicSpace
+from publicspace.settings import BGT_LAYERS, TOP10NL_LAYERS, PUBLIC
+
+# Synthetic data in RD New, spread over several grid cells of 1000 m
+ORIGIN = (30000, 380000)
+WIDTH = 2600
+
+SOURCE_DATA = {
+    'BGT': {
+        'onbegroeidterreindeel': (80, 120, {'fysiek_voorkomen': ['erf', 'gesloten verharding', 'zand']}),
+        'begroeidterreindeel': (100, 150, {'fysiek_voorkomen': ['loofbos', 'heide', 'grasland agrarisch',
+                                                                'bouwland']}),
+        'pand': (100, 40, {}),
+        'wegdeel': (80, 100, {'functie': ['rijbaan lokale weg', 'spoorbaan', 'fietspad']}),
+        'waterdeel': (30, 150, {'type': ['watervlakte', 'waterloop']}),
+        'ondersteunendwaterdeel': (20, 60, {'type': ['oever, slootkant']}),
+        'ondersteunendwegdeel': (30, 40, {'fysiek_voorkomen': ['groenvoorziening']}),
+        'overigbouwwerk': (20, 30, {'type': ['bassin']}),
+        'scheiding_vlak': (15, 20, {'type': ['muur']}),
+        'kunstwerkdeel_vlak': (15, 40, {'type': ['perron', 'steiger']}),
+        'overbruggingsdeel': (10, 40, {'type_overbruggingsdeel': ['dek']}),
+    },
+    'TOP10NL': {
+        'functioneel_gebied_vlak': (8, 500, {'typefunctioneelgebied': ['camping, kampeerterrein', 'haven',
+                                                                       'begraafplaats']}),
+        'functioneel_gebied_multivlak': (3, 400, {'typefunctioneelgebied': ['golfterrein', 'haven']}),
+    }
+}
+
+
+def write_source_data(root):
+    """
+    Write overlapping, rotated rectangles for all BGT and TOP10NL layers, plus one self-intersecting polygon per
+    layer to exercise the repair of invalid geometries.
+
+    :param root: directory in which the BGT and TOP10NL directories are created
+    :return: tuple with the BGT and TOP10NL paths
+    """
+    rng = np.random.default_rng(42)
+    x0, y0 = ORIGIN
+    for source, layers in SOURCE_DATA.items():
+        (root / source).mkdir()
+        for name, (count, size, columns) in layers.items():
+            geoms = []
+            for _ in range(count):
+                x, y = x0 + rng.uniform(0, WIDTH), y0 + rng.uniform(0, WIDTH)
+                w, h = rng.uniform(size / 3, size, 2)
+                geoms.append(affinity.rotate(box(x, y, x + w, y + h), rng.uniform(0, 90)))
+            x, y = x0 + rng.uniform(0, WIDTH), y0 + rng.uniform(0, WIDTH)
+            geoms.append(Polygon([(x, y), (x + 20, y + 20), (x + 20, y), (x, y + 20)]))
+
+            data = {'lokaal_id': [f'{name}{i}' for i in range(len(geoms))]}
+            for column, values in columns.items():
+                data[column] = rng.choice(values, len(geoms))
+            gpd.GeoDataFrame(data, geometry=geoms, crs='EPSG:28992').to_file(root / source / f'{name}.gpkg')
+    return str(root / 'BGT'), str(root / 'TOP10NL')
+
+
+@pytest.fixture(scope='module')
+def source_data(tmp_path_factory):
+    return write_source_data(tmp_path_factory.mktemp('data'))
+
+
+def ordered_difference(steps, covered=Polygon()):
+    """
+    Reference for the classification: every step keeps the area that is not covered by the previous steps.
+
+    :param steps: list of GeoDataFrames in order of priority
+    :param covered: area that is already classified
+    :return: GeoDataFrame with the remaining area of all steps
+    """
+    remaining = []
+    for step in steps:
+        geoms = step.geometry.values.to_numpy()
+        remaining.append(step.set_geometry(shapely.difference(geoms, covered), crs=step.crs))
+        covered = shapely.union(covered, shapely.union_all(geoms))
+    return pd.concat(remaining, ignore_index=True)
+
+
+def area_per_feature(gdf):
+    return gdf.assign(area=gdf.area).groupby(['layer', 'reason', 'source_id'])['area'].sum()
+
+
+def run_analysis(bgt_path, top10nl_path, **kwargs):
+    return PublicSpace(bgt_path=bgt_path, top10nl_path=top10nl_path, bgt_layers=BGT_LAYERS,
+                       top10nl_layers=TOP10NL_LAYERS, bgt_download=False, top10nl_download=False, **kwargs)
+
+
+def test_geoparquet_reads_same_features(tmp_path):
+    bgt_path, top10nl_path = write_source_data(tmp_path)
+    x0, y0 = ORIGIN
+    aoi = gpd.GeoDataFrame(geometry=[box(x0 + 500, y0 + 500, x0 + 1700, y0 + 1500)], crs='EPSG:28992')
+    # A diagonal building whose bounding box overlaps the one of the aoi, while the building itself does not
+    diagonal = LineString([(x0 + 200, y0 + 1400), (x0 + 600, y0 + 1800)]).buffer(2)
+    pyogrio.write_dataframe(gpd.GeoDataFrame({'lokaal_id': ['diagonal']}, geometry=[diagonal], crs='EPSG:28992'),
+                            f'{bgt_path}/pand.gpkg', append=True)
+
+    gpkg = run_analysis(bgt_path, top10nl_path, aoi=aoi)
+    parquet = run_analysis(bgt_path, top10nl_path, aoi=aoi, geoparquet=True)
+
+    assert 'diagonal' not in set(gpkg.bgt['pand']['lokaal_id'])
+    for key, gdf in gpkg.bgt.items():
+        assert sorted(parquet.bgt[key]['lokaal_id']) == sorted(gdf['lokaal_id']), key
+    for key, gdf in gpkg.top10nl.items():
+        assert sorted(parquet.top10nl[key]['lokaal_id']) == sorted(gdf['lokaal_id']), key
+    assert parquet.gdf.area.sum() == pytest.approx(gpkg.gdf.area.sum())
+
+
+def test_classification_matches_ordered_difference(source_data, monkeypatch):
+    # Record the data of all steps, in order of priority, before it is classified per grid cell
+    steps = []
+    materialize = PublicSpace._materialize
+
+    def record_materialize(self):
+        steps.extend(self._pending)
+        materialize(self)
+
+    monkeypatch.setattr(PublicSpace, '_materialize', record_materialize)
+
+    ps = run_analysis(*source_data)
+
+    assert len(steps) > 1
+    result = area_per_feature(ps.gdf)
+    expected = area_per_feature(ordered_difference(steps))
+    expected = expected[expected > 0]
+    pd.testing.assert_index_equal(result.index.sort_values(), expected.index.sort_values())
+    np.testing.assert_allclose(result[expected.index], expected, rtol=1e-9, atol=1e-6)
+
+
+def test_added_data_excludes_classified_area(source_data):
+    ps = run_analysis(*source_data)
+    classified = shapely.union_all(ps.gdf.geometry.values)
+
+    x0, y0 = ORIGIN
+    extra = gpd.GeoDataFrame({'lokaal_id': ['extra']}, geometry=[box(x0 + 800, y0 + 800, x0 + 2300, y0 + 1900)],
+                             crs='EPSG:28992')
+    ps.add_data(extra, source='test', layer='extra', source_id_column='lokaal_id', reason='test',
+                source_category=None, category=PUBLIC)
+    ps._materialize()
+
+    added = ps.gdf[ps.gdf['layer'] == 'extra']
+    expected = ordered_difference([extra], covered=classified)
+    assert added.area.sum() == pytest.approx(expected.area.sum())
+    assert shapely.union_all(added.geometry.values).symmetric_difference(expected.geometry[0]).area < 1e-3